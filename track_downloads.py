@@ -1,11 +1,20 @@
 import argparse
+import hashlib
+import lzma
 import os
 import pandas as pd
 import numpy as np
 import random
+import re
 import string
+import shutil
 import subprocess
+import sys
+import threading
+import time
 import wget
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import datetime
 import yaml
@@ -58,6 +67,62 @@ def get_args():
                                check will be performed first')
     parser.add_argument('--remove-missing', dest='check_remove', action='store_true',
                         help='If checking directory, remove entries with no existing files.')
+    parser.add_argument('--bgzip', dest='bgzip', action='store_true',
+                        help='Re-encode main files as block gzip sorted by position and build a tabix index. \
+                              The new files are added to the unit as associated files. If --subject-id and --unit-id \
+                              are supplied only that unit is processed, otherwise all units without a position index. \
+                              Combined with --url or --update-entry, only the new or updated unit is processed.')
+    parser.add_argument('--chrom-col', dest='chrom_col', type=int, default=1,
+                        help='Column number (starting at 1) of chromosome in main files. Used with --bgzip.')
+    parser.add_argument('--pos-col', dest='pos_col', type=int, default=2,
+                        help='Column number (starting at 1) of position in main files. Used with --bgzip.')
+    parser.add_argument('--skip-lines', dest='skip_lines', type=int, default=1,
+                        help='Number of header lines in main files (default 1). Ignored for vcf files. \
+                              Used with --bgzip.')
+    parser.add_argument('--region', dest='region', default='',
+                        help='Fetch a genomic region in the format chr:start-end from all units with a position index \
+                              (see --bgzip) and print it with the full ID prepended to each line.')
+    parser.add_argument('--region-ids', dest='region_ids', nargs='+', default=[],
+                        help='Full IDs of the units to fetch --region from. Defaults to all indexed units.')
+    parser.add_argument('--threads', dest='threads', type=int, default=4,
+                        help='Number of files to read in parallel (default 4).')
+    parser.add_argument('--out', dest='out', default='',
+                        help='Write the output of --region or --query to this file instead of the screen.')
+    parser.add_argument('--query', dest='query', nargs='+', default=[],
+                        help='Print files matching all of the supplied filters. Filters have the form \
+                              <column><op><value> where op is one of ==, !=, >, >=, <, <= or ^= (starts with). \
+                              Values that look like numbers are compared as numbers. Use quotes if value contains \
+                              white space or > or <, as in --query type==main "trait^=body mass" "sample_size>100000". \
+                              If used with --region, only matching units are read.')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='Keep running and track changes to files in the subject directories listed in the index. \
+                              The status of all files is written to the file given by --status-file whenever it \
+                              changes. Uses inotifywait if it is installed and checks periodically otherwise.')
+    parser.add_argument('--poll-interval', dest='poll_interval', type=int, default=60,
+                        help='Seconds between checks when --watch can not use inotifywait (default 60).')
+    parser.add_argument('--status', dest='status', action='store_true',
+                        help='Print the current status written by a running --watch process.')
+    parser.add_argument('--status-file', dest='status_file', default='',
+                        help='File used by --watch and --status. Defaults to <index>.status')
+    parser.add_argument('--tier', dest='tier', action='store_true',
+                        help='Move selected files to cold storage by compressing them with xz (lzma). The original md5 \
+                              is kept and the md5 of the compressed file is stored in stored_md5. Files are selected with \
+                              --older-than, --min-size, --query and/or --subject-id and --unit-id. \
+                              At least one of these is required.')
+    parser.add_argument('--restore', dest='restore', action='store_true',
+                        help='Decompress files in cold storage and check them against the original md5. \
+                              Uses the same selection options as --tier. With no selection, all files are restored.')
+    parser.add_argument('--older-than', dest='older_than', default='',
+                        help='Select files downloaded before this date (YYYY-MM-DD). Used with --tier or --restore.')
+    parser.add_argument('--min-size', dest='min_size', type=int, default=0,
+                        help='Select files at least this many bytes in size. Used with --tier or --restore.')
+    parser.add_argument('--migrate-from', dest='migrate', default='',
+                        help='Convert a reference file written by get_stats.py into a new reference file with the name \
+                              given by the positional argument. study_id and trait_id become subject_id and unit_id, \
+                              other columns become features and md5 checksums are carried over. Files are checked \
+                              for existence and size in parallel (see --threads) and problems written to a report.')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=100000,
+                        help='Number of lines read at a time by --migrate-from (default 100000).')
     parser.add_argument('--config', dest='config', help="YAML formatted configuration file")
     parser.add_argument('--no-backup', dest='nb', action='store_true',
                         help="Do not create a backup file (default False).")
@@ -152,8 +217,26 @@ def read_add(file, req_feats):
     return new_dat
 
 def check_args(args, ref):
-    if args.url == '' and args.csv == '' and not args.upd and not args.check and not args.remove:
-        raise Exception('You must specify one of --url, --from-file, --update-entry, or --check-directory.')
+    if args.url == '' and args.csv == '' and not args.upd and not args.check and not args.remove \
+            and not args.bgzip and args.region == '' and len(args.query) == 0 and not args.watch and not args.status \
+            and not args.tier and not args.restore and args.migrate == '':
+        raise Exception('You must specify one of --url, --from-file, --update-entry, --check-directory, --bgzip, '
+                        '--region, --query, --watch, --status, --tier, --restore or --migrate-from.')
+
+    if len(args.query) > 0:
+        if args.url != '' or args.upd or args.csv != '' or args.remove or args.check or args.bgzip or args.watch \
+                or args.status or args.migrate != '':
+            raise Exception('--query can only be used on its own or with --region, --tier or --restore.')
+
+    if args.migrate != '':
+        if os.path.exists(args.index[0]):
+            raise Exception('--migrate-from creates a new reference file. Please supply the name of a file '
+                            'that does not exist.')
+        if args.chunk_size < 1:
+            raise Exception('--chunk-size must be at least 1.')
+
+    if args.watch and args.poll_interval < 1:
+        raise Exception('--poll-interval must be at least one second.')
 
     if args.upd and len(args.url) > 0:
         raise Exception('If using --update-entry you may not add a main file.')
@@ -183,6 +266,38 @@ def check_args(args, ref):
     if args.check_remove and not args.check:
         raise Exception('--remove-missing can only be used with --check-directory option.')
 
+    if args.bgzip:
+        if args.csv != '' or args.remove:
+            raise Exception('--bgzip can not be used with --from-file or --remove.')
+        for tool in ['bgzip', 'tabix']:
+            if shutil.which(tool) is None:
+                raise Exception(f'{tool} must be installed to use --bgzip.')
+        if args.url == '' and (args.subject_id == '') != (args.unit_id == ''):
+            raise Exception('To re-encode a single unit, please supply both subject id and unit id.')
+        if args.chrom_col < 1 or args.pos_col < 1 or args.skip_lines < 0:
+            raise Exception('Column numbers must be at least 1 and --skip-lines can not be negative.')
+
+    if args.tier or args.restore:
+        if args.tier and args.restore:
+            raise Exception('--tier and --restore can not be used together.')
+        if args.url != '' or args.upd or args.csv != '' or args.remove or args.check or args.bgzip \
+                or args.region != '' or args.watch or args.migrate != '':
+            raise Exception('--tier and --restore can not be used with --url, --update-entry, --from-file, --remove '
+                            'or other modes.')
+        if (args.subject_id == '') != (args.unit_id == ''):
+            raise Exception('To select a single unit, please supply both subject id and unit id.')
+        if args.tier and args.older_than == '' and args.min_size == 0 and len(args.query) == 0 \
+                and args.subject_id == '':
+            raise Exception('To use --tier, please select files with --older-than, --min-size, --query '
+                            'or --subject-id and --unit-id.')
+
+    if args.region != '':
+        if len(args.region.split(':')) > 2:
+            raise Exception('Regions should be in the format chr:start-end.')
+        for i in args.region_ids:
+            if i not in ref.full_id.to_list():
+                raise Exception(f'{i} is not present in reference file.')
+
 
 def remove_entry(subject_id, unit_id, ref):
     full_id = f'{subject_id}__{unit_id}'
@@ -301,7 +416,7 @@ def check_directory(ref, dir=".", report_file='', remove_missing = False, ignore
                 m5out = subprocess.run(f'md5sum "{f}"', capture_output=True, text=True, shell=True)
                 m5 = m5out.stdout.split()[0]
                 i = list(ref.file).index(f)
-                if m5 == ref.md5[i]:
+                if m5 == expected_md5(ref, i):
                     doc_files_ok.append(f)
                 else:
                     doc_files_notok.append(f)
@@ -380,6 +495,569 @@ def run_one_study(args, ref, inp_features, config):
         ref = ref.replace(np.nan, '')
     return ref
 
+def get_md5(file):
+    res = subprocess.run(f'md5sum "{file}"', capture_output=True, text=True, shell=True)
+    return res.stdout.split()[0]
+
+
+def is_tiered(ref, i):
+    return 'codec' in ref.columns and isinstance(ref.codec[i], str) and ref.codec[i] != ''
+
+
+# md5 of the file as it is stored on disk. For files in cold storage this is the
+# md5 of the compressed file, so they can be checked without decompressing.
+def expected_md5(ref, i):
+    if is_tiered(ref, i):
+        return ref.stored_md5[i]
+    return ref.md5[i]
+
+
+# Sorted, block gzipped copy of a main file. Existing .gz or .bgz extensions are dropped
+# so that file.txt.gz becomes file.txt.sorted.bgz
+def bgzip_name(file):
+    for ext in ['.gz', '.bgz']:
+        if file.endswith(ext):
+            file = file[:-len(ext)]
+    return f'{file}.sorted.bgz'
+
+
+# Returns a dictionary mapping full_id to a file with a tabix index in the same unit.
+# Any file with a matching .tbi file counts, so vcf.gz files downloaded with their index do not
+# need to be re-encoded.
+def indexed_files(ref):
+    fls = set(ref.file.to_list())
+    res = {}
+    for i in ref.index:
+        if f'{ref.file[i]}.tbi' in fls and ref.full_id[i] not in res:
+            res[ref.full_id[i]] = ref.file[i]
+    return res
+
+
+# Re-encode main files as bgzip and build a tabix index. The two new files are added to the unit as
+# associated files. source_md5 records the md5 of the main file they were made from.
+# The index is written after each unit so that it is never out of date if the program stops part way.
+def bgzip_entries(ref, index_file, full_ids=(), chrom_col=1, pos_col=2, skip_lines=1):
+    for tool in ['bgzip', 'tabix']:
+        if shutil.which(tool) is None:
+            raise Exception(f'{tool} must be installed to use --bgzip.')
+    done = indexed_files(ref)
+    if len(full_ids) == 0:
+        full_ids = [i for i in ref.query('type == "main"').full_id.to_list() if i not in done]
+    if 'source_md5' not in ref.columns:
+        ref['source_md5'] = ''
+    for fid in full_ids:
+        if fid in done:
+            print(f'{fid} already has a position index.')
+            continue
+        main = ref.query(f'full_id == "{fid}" and type == "main"')
+        if len(main) == 0:
+            print(f'{fid} has no main file. Skipping.')
+            continue
+        i = main.index[0]
+        f = ref.file[i]
+        if is_tiered(ref, i):
+            print(f'{f} is in cold storage. Run --restore first. Skipping.')
+            continue
+        if not os.path.exists(f):
+            print(f'{f} is documented but not present. Skipping.')
+            continue
+        if get_md5(f) != ref.md5[i]:
+            print(f'{f} is documented but md5 sums do not match. Skipping.')
+            continue
+        out = bgzip_name(f)
+        print(f'Re-encoding {f} to {out}')
+        # pipefail so that a file that fails to decompress part way is not indexed. The header is read
+        # without pipefail because head closing the pipe early makes zcat exit with an error.
+        if any([os.path.basename(f).endswith(ext) for ext in ['.vcf', '.vcf.gz', '.vcf.bgz']]):
+            cmd = f'set -o pipefail; (zcat -f "{f}" | grep "^#"; ' \
+                  f'zcat -f "{f}" | grep -v "^#" | sort -t "$(printf \'\\t\')" -k1,1 -k2,2n) ' \
+                  f'| bgzip -c > "{out}" && tabix -f -p vcf "{out}"'
+        else:
+            cmd = f'set -o pipefail; ( (set +o pipefail; zcat -f "{f}" | head -n {skip_lines}); ' \
+                  f'zcat -f "{f}" | tail -n +{skip_lines + 1} ' \
+                  f'| sort -t "$(printf \'\\t\')" -k{chrom_col},{chrom_col} -k{pos_col},{pos_col}n) ' \
+                  f'| bgzip -c > "{out}" && tabix -f -s {chrom_col} -b {pos_col} -e {pos_col} -S {skip_lines} "{out}"'
+        res = subprocess.run(cmd, capture_output=True, text=True, shell=True, executable='/bin/bash')
+        if res.returncode != 0:
+            print(f'Could not index {f}:\n{res.stderr}')
+            for x in [out, f'{out}.tbi']:
+                if os.path.exists(x):
+                    os.remove(x)
+            continue
+        new_ref = pd.DataFrame([ref.loc[i, :]] * 2)
+        new_ref['file'] = [out, f'{out}.tbi']
+        new_ref['url'] = [f'bgzip:{ref.url[i]}', f'tabix:{ref.url[i]}']
+        new_ref['date_downloaded'] = str(date.today())
+        new_ref['md5'] = [get_md5(out), get_md5(f'{out}.tbi')]
+        new_ref['type'] = 'associated'
+        new_ref['source_md5'] = ref.md5[i]
+        ref = pd.concat([ref, new_ref], ignore_index=True)
+        ref = ref.replace(np.nan, '')
+        ref.to_csv(index_file, index=False)
+    return ref
+
+
+def fetch_region(file, region):
+    res = subprocess.run(['tabix', file, region], capture_output=True, text=True)
+    if res.returncode != 0:
+        print(f'Could not read {region} from {file}:\n{res.stderr}', file=sys.stderr)
+        return ''
+    return res.stdout
+
+
+# Read one region from many indexed files in parallel using tabix random access.
+# Output lines are prefixed with full_id.
+def query_region(ref, region, full_ids=(), threads=4, out_file=''):
+    if shutil.which('tabix') is None:
+        raise Exception('tabix must be installed to use --region.')
+    files = indexed_files(ref)
+    if len(full_ids) == 0:
+        full_ids = list(files.keys())
+    for i in full_ids:
+        if i not in files:
+            print(f'{i} does not have a position index. Run --bgzip first.', file=sys.stderr)
+    full_ids = [i for i in full_ids if i in files]
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        res = ex.map(lambda i: fetch_region(files[i], region), full_ids)
+        out = open(out_file, 'w') if len(out_file) > 0 else sys.stdout
+        for fid, txt in zip(full_ids, res):
+            out.writelines([f'{fid}\t{line}\n' for line in txt.splitlines()])
+        if len(out_file) > 0:
+            out.close()
+            print(f'Results saved in {out_file}')
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_filter(filt):
+    m = re.match(r'^\s*([^=!<>^\s]+)\s*(==|!=|>=|<=|\^=|>|<)\s*(.*?)\s*$', filt)
+    if m is None:
+        raise Exception(f'Could not parse filter {filt}. Filters should have the form <column><op><value>.')
+    return m.groups()
+
+
+# In memory view of a reference file for use from other scripts, e.g.
+#   from track_downloads import Catalog
+#   cat = Catalog('my_reference.csv')
+#   cat.files('type==main', 'date_downloaded>=2023-01-01', 'sample_size>100000')
+# Secondary indexes are built up front for subject_id, unit_id, type and all features
+# and on first use for any other column.
+class Catalog:
+    index_vars = ['subject_id', 'unit_id', 'type']
+
+    def __init__(self, file=None, ref=None):
+        if ref is None:
+            ref = read_index(file, new_ok=False, create_backup=False)
+        else:
+            validate_index(ref)
+        self.ref = ref.replace(np.nan, '').reset_index(drop=True)
+        self.indexes = {}
+        features = set(self.ref.columns) - set(req_vars())
+        for v in self.index_vars + sorted(features):
+            self.build_index(v)
+
+    # Each index holds a dictionary from value to row numbers, the sorted distinct values for
+    # string comparisons and prefix matches, and the values that can be read as numbers as two
+    # lists sorted by number: the numbers themselves and the original values
+    def build_index(self, var):
+        if var not in self.ref.columns:
+            raise Exception(f'{var} is not a column in the reference file.')
+        rows = {}
+        for i, value in enumerate(self.ref[var].astype(str).to_list()):
+            rows.setdefault(value, []).append(i)
+        keys = sorted(k for k in rows.keys() if k != '')
+        pairs = sorted((to_number(k), k) for k in keys if to_number(k) is not None)
+        nums = ([n for n, k in pairs], [k for n, k in pairs])
+        self.indexes[var] = (rows, keys, nums)
+        return self.indexes[var]
+
+    def match(self, var, op, value):
+        rows, keys, nums = self.indexes[var] if var in self.indexes else self.build_index(var)
+        if op in ['==', '!=']:
+            x = to_number(value)
+            if x is not None:
+                same = nums[1][bisect_left(nums[0], x):bisect_right(nums[0], x)]
+            else:
+                same = [value]
+            res = set(i for k in same for i in rows.get(k, []))
+            if op == '!=':
+                res = set(range(len(self.ref))) - res
+            return res
+        if op == '^=':
+            keep = keys[bisect_left(keys, value):bisect_left(keys, value + '\uffff')]
+        else:
+            x = to_number(value)
+            if x is not None:
+                srt, all_keys = nums
+            else:
+                x = value
+                srt = keys
+                all_keys = keys
+            if op == '>':
+                keep = all_keys[bisect_right(srt, x):]
+            elif op == '>=':
+                keep = all_keys[bisect_left(srt, x):]
+            elif op == '<':
+                keep = all_keys[:bisect_left(srt, x)]
+            else:
+                keep = all_keys[:bisect_right(srt, x)]
+        return set(i for k in keep for i in rows[k])
+
+    # Returns the lines of the reference file that match all filters
+    def query(self, *filters):
+        if len(filters) == 0:
+            return self.ref
+        res = self.match(*parse_filter(filters[0]))
+        for filt in filters[1:]:
+            if len(res) == 0:
+                break
+            res = res & self.match(*parse_filter(filt))
+        return self.ref.iloc[sorted(res)]
+
+    def files(self, *filters):
+        return self.query(*filters).file.to_list()
+
+    def full_ids(self, *filters):
+        return list(dict.fromkeys(self.query(*filters).full_id.to_list()))
+
+
+# Keeps the status of all files in the documented subject directories in memory so that
+# the tree only has to be walked once. Files are re-hashed only when their size or
+# modification time changes. The index is re-read when it is modified.
+class DirectoryWatcher:
+    def __init__(self, index, status_file, ignore_dirs=()):
+        self.index = index
+        self.status_file = status_file
+        self.ignore_dirs = ignore_dirs
+        self.stats = {}  # path: (size, mtime) for all files present
+        self.hashes = {}  # path: md5 for documented files present
+        self.load_index()
+
+    def load_index(self):
+        self.index_mtime = os.path.getmtime(self.index)
+        ref = read_index(self.index, new_ok=False, create_backup=False).replace(np.nan, '')
+        paths = [os.path.abspath(f) for f in ref.file.to_list()]
+        self.names = dict(zip(paths, ref.file.to_list()))
+        self.md5 = dict(zip(paths, [expected_md5(ref, i) for i in ref.index]))
+        self.ids = dict(zip(paths, zip(ref.subject_id.to_list(), ref.unit_id.to_list())))
+        self.dirs = [os.path.abspath(d) for d in dict.fromkeys(ref.subject_id.to_list()) if d not in self.ignore_dirs]
+        for p in list(self.stats):
+            if p in self.md5 and p not in self.hashes:
+                self.rehash(p)
+
+    # Returns True if the index was modified and has been re-read
+    def check_index(self):
+        if os.path.getmtime(self.index) == self.index_mtime:
+            return False
+        print(f'{self.index} has changed. Reloading.')
+        self.load_index()
+        return True
+
+    def forget(self, path):
+        for p in [p for p in self.stats if p == path or p.startswith(path + '/')]:
+            del self.stats[p]
+            self.hashes.pop(p, None)
+
+    # Files can be removed or renamed while they are being hashed. These are treated as removed.
+    def rehash(self, path):
+        try:
+            self.hashes[path] = get_md5(path)
+        except IndexError:
+            self.forget(path)
+
+    def refresh(self, path):
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    self.refresh(os.path.join(root, f))
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return
+        if not os.path.isfile(path):
+            self.forget(path)
+            return
+        if self.stats.get(path) == (st.st_size, st.st_mtime_ns):
+            return
+        self.stats[path] = (st.st_size, st.st_mtime_ns)
+        if path in self.md5:
+            self.rehash(path)
+
+    def scan(self):
+        present = set()
+        for d in self.dirs:
+            for root, dirs, files in os.walk(d):
+                for f in files:
+                    p = os.path.join(root, f)
+                    present.add(p)
+                    self.refresh(p)
+        for p in set(self.stats) - present:
+            self.forget(p)
+
+    def write_status(self):
+        ok = [p for p in sorted(self.stats) if p in self.md5 and self.hashes[p] == self.md5[p]]
+        notok = [p for p in sorted(self.stats) if p in self.md5 and self.hashes[p] != self.md5[p]]
+        undoc = [p for p in sorted(self.stats) if p not in self.md5]
+        missing = [p for p in self.md5 if p not in self.stats]
+        with open(f'{self.status_file}.tmp', 'w') as f:
+            f.writelines([f'Status written on {str(datetime.now())}\n\n',
+                          f'{len(ok)} files which are documented with matching md5 checksums\n',
+                          f'{len(notok)} files which are documented but have non-matching md5 checksums:\n'])
+            f.writelines([f'{self.names[p]}\n' for p in notok])
+            f.writelines([f'\n{len(undoc)} file which are undocumented:\n'])
+            f.writelines([f'{p}\n' for p in undoc])
+            f.writelines([f'\n{len(missing)} are documented but not present in directory:\n'])
+            f.writelines([f'{self.ids[p][0]}, {self.ids[p][1]}: {self.names[p]} \n' for p in missing])
+        os.replace(f'{self.status_file}.tmp', self.status_file)
+
+    def poll(self, poll_interval=60):
+        print(f'Checking for changes every {poll_interval} seconds.')
+        self.scan()
+        self.write_status()
+        while True:
+            time.sleep(poll_interval)
+            self.check_index()
+            self.scan()
+            self.write_status()
+
+    def watch(self, poll_interval=60):
+        print(f'Watching {len(self.dirs)} directories. Status is saved in {self.status_file}')
+        if shutil.which('inotifywait') is None:
+            print('inotifywait not found.')
+            self.poll(poll_interval)
+        index = os.path.abspath(self.index)
+        index_dir = os.path.dirname(index)
+        while True:
+            # The subject directories are watched recursively. The directory containing the index is watched on its
+            # own so that an index replaced by renaming is still noticed. Both write to the same pipe.
+            dirs = [d for d in self.dirs if os.path.isdir(d)]
+            cmds = [['inotifywait', '-m', '-e', 'close_write,moved_to', '--format', '%w%f', index_dir]]
+            if len(dirs) > 0:
+                cmds.append(['inotifywait', '-m', '-r', '-e', 'close_write,moved_to,moved_from,delete',
+                             '--format', '%w%f'] + dirs)
+            r, w = os.pipe()
+            procs = [subprocess.Popen(cmd, stdout=w, stderr=subprocess.PIPE, text=True) for cmd in cmds]
+            os.close(w)
+            events = os.fdopen(r)
+            try:
+                # Scan only once watches are in place so that no changes are missed in between
+                if not all([watches_established(proc) for proc in procs]):
+                    print('inotifywait could not start. This can happen if there are more files than the '
+                          'limit in fs.inotify.max_user_watches.')
+                    break
+                for proc in procs:
+                    threading.Thread(target=forward_stderr, args=(proc,), daemon=True).start()
+                self.scan()
+                self.write_status()
+                for line in events:
+                    path = os.path.abspath(line.rstrip('\n'))
+                    if path == index:
+                        # subject directories may have changed so inotifywait is restarted
+                        if self.check_index():
+                            break
+                        continue
+                    if os.path.dirname(path) == index_dir:
+                        continue
+                    self.refresh(path)
+                    self.write_status()
+                else:
+                    print('inotifywait stopped unexpectedly.')
+                    break
+            finally:
+                for proc in procs:
+                    proc.terminate()
+                events.close()
+        self.poll(poll_interval)
+
+
+def watches_established(proc):
+    for line in proc.stderr:
+        if 'Watches established' in line:
+            return True
+    return False
+
+
+# inotifywait keeps writing warnings to stderr. These are passed on so that the pipe never fills up.
+def forward_stderr(proc):
+    for line in proc.stderr:
+        print(line, end='', file=sys.stderr)
+
+
+# Returns index labels of lines in ref selected by the --tier and --restore options
+def select_entries(ref, query=(), older_than='', min_size=0, full_id=''):
+    sel = pd.Series(True, index=ref.index)
+    if len(query) > 0:
+        sel = sel & ref.file.isin(Catalog(ref=ref).files(*query))
+    if older_than != '':
+        sel = sel & (ref.date_downloaded < older_than)
+    if full_id != '':
+        sel = sel & (ref.full_id == full_id)
+    idx = ref.index[sel].to_list()
+    if min_size > 0:
+        idx = [i for i in idx if os.path.exists(ref.file[i]) and os.path.getsize(ref.file[i]) >= min_size]
+    return idx
+
+
+# Copy file_in to file_out using open_in and open_out. A partial output is removed if anything goes wrong,
+# including the user interrupting the program.
+def convert_file(file_in, file_out, open_in=open, open_out=open):
+    try:
+        with open_in(file_in, 'rb') as f_in, open_out(file_out, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    except BaseException:
+        if os.path.exists(file_out):
+            os.remove(file_out)
+        raise
+
+
+# Compress files in place with xz. file is changed to the compressed file, md5 keeps the md5 of
+# the original and stored_md5 the md5 of the compressed file. The index is written after each file
+# and before the original is removed so that it is never out of date if the program stops part way.
+def tier_entries(ref, idx, index_file):
+    for v in ['codec', 'stored_md5']:
+        if v not in ref.columns:
+            ref[v] = ''
+    ref = ref.replace(np.nan, '')
+    for i in idx:
+        f = ref.file[i]
+        if is_tiered(ref, i):
+            continue
+        if any([f.endswith(ext) for ext in ['.gz', '.bgz', '.tbi', '.xz', '.bz2', '.zip']]):
+            print(f'{f} is already compressed. Skipping.')
+            continue
+        if not os.path.exists(f):
+            print(f'{f} is documented but not present. Skipping.')
+            continue
+        if get_md5(f) != ref.md5[i]:
+            print(f'{f} is documented but md5 sums do not match. Skipping.')
+            continue
+        out = f'{f}.xz'
+        if os.path.exists(out):
+            raise Exception(f'{out} already exists. Please move or remove it before using --tier.')
+        print(f'Compressing {f}')
+        convert_file(f, out, open_out=lzma.open)
+        ref.loc[i, 'stored_md5'] = get_md5(out)
+        ref.loc[i, 'codec'] = 'xz'
+        ref.loc[i, 'file'] = out
+        ref.to_csv(index_file, index=False)
+        os.remove(f)
+    return ref
+
+
+def restore_entries(ref, idx, index_file):
+    for i in idx:
+        if not is_tiered(ref, i):
+            continue
+        f = ref.file[i]
+        if ref.codec[i] != 'xz':
+            raise Exception(f'Unrecognized codec {ref.codec[i]} for {f}.')
+        if not os.path.exists(f):
+            print(f'{f} is documented but not present. Skipping.')
+            continue
+        out = f[:-len('.xz')]
+        if os.path.exists(out):
+            raise Exception(f'{out} already exists. Please move or remove it before using --restore.')
+        print(f'Restoring {out}')
+        convert_file(f, out, open_in=lzma.open)
+        if get_md5(out) != ref.md5[i]:
+            print(f'{out} does not match the original md5 sum. Keeping {f}.')
+            os.remove(out)
+            continue
+        ref.loc[i, 'file'] = out
+        ref.loc[i, 'codec'] = ''
+        ref.loc[i, 'stored_md5'] = ''
+        ref.to_csv(index_file, index=False)
+        os.remove(f)
+    return ref
+
+
+def file_size(file):
+    if os.path.isfile(file):
+        return os.path.getsize(file)
+    return None
+
+
+# Convert a reference file written by get_stats.py, reading chunk_size lines at a time so memory use does not
+# depend on the size of the reference. md5 checksums are carried over rather than re-computed. Files are only
+# checked for existence and size: against the size column if there is one, otherwise a file is flagged if it
+# is empty but its md5 is not the md5 of an empty file or the other way around.
+def migrate_index(old_file, new_file, chunk_size=100000, threads=4, report_file=''):
+    if not os.path.exists(old_file):
+        raise Exception(f'{old_file} does not exist.')
+    rename = {'study_id': 'subject_id', 'trait_id': 'unit_id'}
+    empty_md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+    cols = pd.read_csv(old_file, header=0, dtype='str', nrows=0).columns.to_list()
+    if any([v not in cols for v in rename.keys()]):
+        raise Exception(f'{old_file} does not look like it was written by get_stats.py. '
+                        'Columns study_id and trait_id are required.')
+    cols = [rename.get(c, c) for c in cols]
+    cols = [v for v in req_vars() if v in cols] + [c for c in cols if c not in req_vars()]
+    tmp_file = f'{new_file}.tmp'
+    pd.DataFrame({c: [] for c in cols}).to_csv(tmp_file, index=False)
+    n = 0
+    n_missing = 0
+    n_wrong_size = 0
+    # files and urls already seen are kept as md5 digests to check for duplicates across chunks in little memory
+    seen_files = set()
+    seen_urls = set()
+    report = open(report_file, 'w') if len(report_file) > 0 else open(os.devnull, 'w')
+    report.writelines([f'Migration report for {old_file} written on {str(date.today())}\n\n'])
+    try:
+        with report, ThreadPoolExecutor(max_workers=threads) as ex:
+            for chunk in pd.read_csv(old_file, header=0, dtype='str', chunksize=chunk_size):
+                chunk = chunk.rename(columns=rename)[cols]
+                validate_index(chunk)
+                for x, seen in [(chunk.file, seen_files), (chunk.url, seen_urls)]:
+                    for v in x.to_list():
+                        key = hashlib.md5(v.encode()).digest()
+                        if key in seen:
+                            raise Exception(f'{v} is duplicated in {old_file}.')
+                        seen.add(key)
+                sizes = list(ex.map(file_size, chunk.file.to_list()))
+                for i, sz in zip(chunk.index, sizes):
+                    if sz is None:
+                        n_missing += 1
+                        report.writelines([f'missing: {chunk.subject_id[i]}, {chunk.unit_id[i]}: {chunk.file[i]}\n'])
+                        continue
+                    if 'size' in cols and isinstance(chunk['size'][i], str):
+                        ok = str(sz) == chunk['size'][i]
+                    else:
+                        ok = (sz == 0) == (chunk.md5[i] == empty_md5)
+                    if not ok:
+                        n_wrong_size += 1
+                        report.writelines([f'wrong size: {chunk.subject_id[i]}, {chunk.unit_id[i]}: {chunk.file[i]}\n'])
+                chunk.to_csv(tmp_file, mode='a', header=False, index=False)
+                n += len(chunk)
+                print(f'Migrated {n} lines')
+            report.writelines([f'\n{n} lines migrated\n',
+                               f'{n_missing} files are documented but not present\n',
+                               f'{n_wrong_size} files do not have the expected size\n'])
+    except BaseException:
+        for f in [tmp_file, report_file]:
+            if len(f) > 0 and os.path.exists(f):
+                os.remove(f)
+        raise
+    os.replace(tmp_file, new_file)
+    print(f'{n} lines written to {new_file}. {n_missing} files are missing and {n_wrong_size} have unexpected sizes.')
+    if len(report_file) > 0:
+        print(f'Full report saved in {report_file}')
+
+
+def print_status(status_file):
+    if not os.path.exists(status_file):
+        raise Exception(f'{status_file} does not exist. Is --watch running?')
+    with open(status_file) as f:
+        print(f.read())
+
+
 def validate_index(ref):
     rv = req_vars()
     if any([i not in ref.columns for i in rv]):
@@ -397,9 +1075,19 @@ def validate_index(ref):
 if __name__ == '__main__':
     parser = get_args()
     args = parser.parse_args()
+    status_file = args.status_file if args.status_file != '' else f'{args.index[0]}.status'
+    if args.status:
+        # answered from the file kept by --watch without reading the index
+        print_status(status_file)
+        sys.exit()
     new_ok = (not args.upd) and (not args.remove)
-    backup = not (args.check or args.nb)
-    ref = read_index(args.index[0], new_ok=new_ok, create_backup=backup) # validate is called at the end of read_index so we can now assume index is valid
+    backup = not (args.check or args.nb or args.region != '' or args.watch or args.migrate != '' \
+                  or (len(args.query) > 0 and not (args.tier or args.restore)))
+    if args.migrate != '':
+        # the new reference is written by migrate_index
+        ref = pd.DataFrame({v: [] for v in req_vars()})
+    else:
+        ref = read_index(args.index[0], new_ok=new_ok, create_backup=backup) # validate is called at the end of read_index so we can now assume index is valid
     check_args(args, ref)
     config = read_config(args.config)
     if args.remove:
@@ -414,6 +1102,45 @@ if __name__ == '__main__':
         inp_feats = parse_features(args.features)
         ref = run_one_study(args, ref, inp_features=inp_feats, config=config)
         ref.to_csv(args.index[0], index=False)
+        if args.bgzip:
+            ref = bgzip_entries(ref, args.index[0], [f'{args.subject_id}__{args.unit_id}'], chrom_col=args.chrom_col,
+                                pos_col=args.pos_col, skip_lines=args.skip_lines)
+    elif args.migrate != '':
+        report_file = f'report.{"_".join(str(datetime.now()).split())}'
+        migrate_index(args.migrate, args.index[0], chunk_size=args.chunk_size, threads=args.threads,
+                      report_file=report_file)
+    elif args.watch:
+        watcher = DirectoryWatcher(args.index[0], status_file, ignore_dirs=config['ignore_dirs'])
+        try:
+            watcher.watch(poll_interval=args.poll_interval)
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+    elif args.tier or args.restore:
+        full_id = f'{args.subject_id}__{args.unit_id}' if args.subject_id != '' else ''
+        idx = select_entries(ref, args.query, older_than=args.older_than, min_size=args.min_size, full_id=full_id)
+        if args.tier:
+            ref = tier_entries(ref, idx, args.index[0])
+        else:
+            ref = restore_entries(ref, idx, args.index[0])
+    elif args.bgzip:
+        full_ids = [f'{args.subject_id}__{args.unit_id}'] if args.subject_id != '' else []
+        ref = bgzip_entries(ref, args.index[0], full_ids, chrom_col=args.chrom_col, pos_col=args.pos_col,
+                            skip_lines=args.skip_lines)
+    elif args.region != '':
+        region_ids = args.region_ids
+        if len(args.query) > 0:
+            region_ids = [i for i in Catalog(ref=ref).full_ids(*args.query) if len(region_ids) == 0 or i in region_ids]
+            if len(region_ids) == 0:
+                raise Exception('No units match the supplied query.')
+        query_region(ref, args.region, region_ids, threads=args.threads, out_file=args.out)
+    elif len(args.query) > 0:
+        fls = Catalog(ref=ref).files(*args.query)
+        if len(args.out) > 0:
+            with open(args.out, 'w') as f:
+                f.writelines([f'{x}\n' for x in fls])
+            print(f'{len(fls)} files saved in {args.out}')
+        else:
+            print('\n'.join(fls))
     elif args.csv:
         rv_in = ['subject_id', 'unit_id', 'full_id', 'url', 'url_assoc']
         add_ref = read_add(args.csv, rv_in)
@@ -433,6 +1160,14 @@ if __name__ == '__main__':
             my_args.check = False
             my_args.remove = False
             my_args.check_remove = False
+            my_args.bgzip = False
+            my_args.region = ''
+            my_args.query = []
+            my_args.watch = False
+            my_args.status = False
+            my_args.tier = False
+            my_args.restore = False
+            my_args.migrate = ''
             check_args(my_args, ref)
             inp_features = my_line[adtl_features].to_dict()
             ref = run_one_study(my_args, ref, inp_features=inp_features, config=config)